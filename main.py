@@ -1,5 +1,4 @@
 import hydra
-import copy
 import os
 import argparse
 
@@ -14,11 +13,12 @@ from src.retrieval import make_retrieval_datasets
 def main(cf_name):
     @hydra.main(config_path="configs", config_name=cf_name)
     def inner_main(cfg: DictConfig):
-        cfg = copy.deepcopy(cfg)
+        # cfg는 여기서 읽기만 하므로 전체 tree를 복사할 필요가 없습니다.
         print(f"Start {cfg.project.name} !")
         if cfg.mode == "model_train":
-            os.environ["WANDB_ENTITY"] = cfg.wandb.entity
-            os.environ["WANDB_PROJECT"] = cfg.wandb.project
+            # wandb는 init때 한번만 읽으므로 이미 설정돼있으면 다시 쓰지 않습니다.
+            os.environ.setdefault("WANDB_ENTITY", cfg.wandb.entity)
+            os.environ.setdefault("WANDB_PROJECT", cfg.wandb.project)
             train(cfg.project, cfg.model, cfg.data, cfg.train, cfg.early_stopping)
         elif cfg.mode == "hyperparameter_tune":
             hp_optimizing(cfg.project, cfg.model, cfg.data, cfg.hp)
@@ -1,10 +1,66 @@
+import numpy as np
+
+from numba import njit, prange
+
+# T5 입력 프롬프트 조각. extra input이 전체 input의 prefix가 되도록 구성합니다.
+QUESTION_PREFIX = "질문: "
+CONTEXT_PREFIX = "  지문:"
+
+
+@njit(cache=True, parallel=True)
+def _align_answer_spans(offsets, context_mask, cls_indices, start_chars, end_chars):
+    # 정답 char 구간을 token 구간으로 옮기는 스캔을 feature 단위로 컴파일된 루프에서 수행합니다.
+    # start_chars[i] < 0 은 정답이 없는 feature를 의미합니다.
+    num_features = offsets.shape[0]
+    max_len = offsets.shape[1]
+    start_positions = np.empty(num_features, dtype=np.int64)
+    end_positions = np.empty(num_features, dtype=np.int64)
+    for i in prange(num_features):
+        cls_index = cls_indices[i]
+        start_char = start_chars[i]
+        end_char = end_chars[i]
+        if start_char < 0:
+            start_positions[i] = cls_index
+            end_positions[i] = cls_index
+            continue
+
+        # context에 해당하는 토큰 구간의 양 끝을 찾습니다.
+        token_start_index = 0
+        while context_mask[i, token_start_index] == 0:
+            token_start_index += 1
+        token_end_index = max_len - 1
+        while context_mask[i, token_end_index] == 0:
+            token_end_index -= 1
+
+        # 정답이 현재 span 밖에 있으면 CLS 토큰을 가리키게 합니다.
+        if not (
+            offsets[i, token_start_index, 0] <= start_char
+            and offsets[i, token_end_index, 1] >= end_char
+        ):
+            start_positions[i] = cls_index
+            end_positions[i] = cls_index
+        else:
+            while (
+                token_start_index < max_len
+                and offsets[i, token_start_index, 0] <= start_char
+            ):
+                token_start_index += 1
+            start_positions[i] = token_start_index - 1
+            while offsets[i, token_end_index, 1] >= end_char:
+                token_end_index -= 1
+            end_positions[i] = token_end_index + 1
+    return start_positions, end_positions
+
+
 def prepare_train_features_with_setting(tokenizer, dataset_args, is_roberta):
+    # tokenizer에만 의존하므로 배치마다 다시 계산할 필요가 없습니다.
+    pad_on_right = tokenizer.padding_side == "right"
+
     def prepare_train_features(examples):
         # Some of the questions have lots of whitespace on the left, which is not useful and will make the
         # truncation of the context fail (the tokenized question will take a lots of space). So we remove that
         # left whitespace
         examples["question"] = [q.lstrip() for q in examples["question"]]
-        pad_on_right = tokenizer.padding_side == "right"
 
         # Tokenize our examples with truncation and padding, but keep the overflows using a stride. This results
         # in one example possible giving several features when a context is long, each of those features having a
@@ -29,58 +85,42 @@ def prepare_train_features_with_setting(tokenizer, dataset_args, is_roberta):
         offset_mapping = tokenized_examples.pop("offset_mapping")
 
         # Let's label those examples!
-        tokenized_examples["start_positions"] = []
-        tokenized_examples["end_positions"] = []
-
-        for i, offsets in enumerate(offset_mapping):
-            # We will label impossible answers with the index of the CLS token.
-            input_ids = tokenized_examples["input_ids"][i]
-            cls_index = input_ids.index(tokenizer.cls_token_id)
-
-            # Grab the sequence corresponding to that example (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
+        # Python 루프 대신 numba 커널로 한번에 정렬할 수 있도록 배열로 모아둡니다.
+        num_features = len(tokenized_examples["input_ids"])
+        offsets_arr = np.array(offset_mapping, dtype=np.int32)
+        input_ids_arr = np.array(tokenized_examples["input_ids"], dtype=np.int32)
+
+        # We will label impossible answers with the index of the CLS token.
+        cls_indices = np.argmax(input_ids_arr == tokenizer.cls_token_id, axis=1)
+
+        # Grab the sequence corresponding to each example (to know what is the context and what is the question).
+        context_index = 1 if pad_on_right else 0
+        context_mask = np.array(
+            [
+                [
+                    1 if sequence_id == context_index else 0
+                    for sequence_id in tokenized_examples.sequence_ids(i)
+                ]
+                for i in range(num_features)
+            ],
+            dtype=np.int8,
+        )
 
+        # Start/end character index of the answer in the text. (-1 : no answer)
+        start_chars = np.full(num_features, -1, dtype=np.int64)
+        end_chars = np.full(num_features, -1, dtype=np.int64)
+        for i in range(num_features):
             # One example can give several spans, this is the index of the example containing this span of text.
-            sample_index = sample_mapping[i]
-            answers = examples["answers"][sample_index]
-            # If no answers are given, set the cls_index as answer.
-            if len(answers["answer_start"]) == 0:
-                tokenized_examples["start_positions"].append(cls_index)
-                tokenized_examples["end_positions"].append(cls_index)
-            else:
-                # Start/end character index of the answer in the text.
-                start_char = answers["answer_start"][0]
-                end_char = start_char + len(answers["text"][0])
-
-                # Start token index of the current span in the text.
-                token_start_index = 0
-                while sequence_ids[token_start_index] != (1 if pad_on_right else 0):
-                    token_start_index += 1
-
-                # End token index of the current span in the text.
-                token_end_index = len(input_ids) - 1
-                while sequence_ids[token_end_index] != (1 if pad_on_right else 0):
-                    token_end_index -= 1
+            answers = examples["answers"][sample_mapping[i]]
+            if len(answers["answer_start"]) != 0:
+                start_chars[i] = answers["answer_start"][0]
+                end_chars[i] = start_chars[i] + len(answers["text"][0])
 
-                # Detect if the answer is out of the span (in which case this feature is labeled with the CLS index).
-                if not (
-                    offsets[token_start_index][0] <= start_char
-                    and offsets[token_end_index][1] >= end_char
-                ):
-                    tokenized_examples["start_positions"].append(cls_index)
-                    tokenized_examples["end_positions"].append(cls_index)
-                else:
-                    # Otherwise move the token_start_index and token_end_index to the two ends of the answer.
-                    # Note: we could go after the last offset if the answer is the last word (edge case).
-                    while (
-                        token_start_index < len(offsets)
-                        and offsets[token_start_index][0] <= start_char
-                    ):
-                        token_start_index += 1
-                    tokenized_examples["start_positions"].append(token_start_index - 1)
-                    while offsets[token_end_index][1] >= end_char:
-                        token_end_index -= 1
-                    tokenized_examples["end_positions"].append(token_end_index + 1)
+        start_positions, end_positions = _align_answer_spans(
+            offsets_arr, context_mask, cls_indices, start_chars, end_chars
+        )
+        tokenized_examples["start_positions"] = start_positions.tolist()
+        tokenized_examples["end_positions"] = end_positions.tolist()
 
         return tokenized_examples
 
@@ -88,12 +128,14 @@ def prepare_train_features_with_setting(tokenizer, dataset_args, is_roberta):
 
 
 def prepare_validation_features_with_setting(tokenizer, dataset_args, is_roberta):
+    # tokenizer에만 의존하므로 배치마다 다시 계산할 필요가 없습니다.
+    pad_on_right = tokenizer.padding_side == "right"
+
     def prepare_validation_features(examples):
         # Some of the questions have lots of whitespace on the left, which is not useful and will make the
         # truncation of the context fail (the tokenized question will take a lots of space). So we remove that
         # left whitespace
         examples["question"] = [q.lstrip() for q in examples["question"]]
-        pad_on_right = tokenizer.padding_side == "right"
 
         # Tokenize our examples with truncation and maybe padding, but keep the overflows using a stride. This results
         # in one example possible giving several features when a context is long, each of those features having a
@@ -117,11 +159,18 @@ def prepare_validation_features_with_setting(tokenizer, dataset_args, is_roberta
         # We keep the example_id that gave us this feature and we will store the offset mappings.
         tokenized_examples["example_id"] = []
 
-        for i in range(len(tokenized_examples["input_ids"])):
-            # Grab the sequence corresponding to that example (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-            context_index = 1 if pad_on_right else 0
+        # context 토큰 위치를 feature 전체에 대해 한번에 미리 계산해둡니다.
+        num_features = len(tokenized_examples["input_ids"])
+        context_index = 1 if pad_on_right else 0
+        context_mask = [
+            [
+                sequence_id == context_index
+                for sequence_id in tokenized_examples.sequence_ids(i)
+            ]
+            for i in range(num_features)
+        ]
 
+        for i in range(num_features):
             # One example can give several spans, this is the index of the example containing this span of text.
             sample_index = sample_mapping[i]
             tokenized_examples["example_id"].append(examples["id"][sample_index])
@@ -129,7 +178,7 @@ def prepare_validation_features_with_setting(tokenizer, dataset_args, is_roberta
             # Set to None the offset_mapping that are not part of the context so it's easy to determine if a token
             # position is part of the context or not.
             tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
+                (o if context_mask[i][k] else None)
                 for k, o in enumerate(tokenized_examples["offset_mapping"][i])
             ]
 
@@ -144,11 +193,13 @@ def prepare_train_features_with_setting_for_T5(tokenizer, dataset_args, is_rober
         # truncation of the context fail (the tokenized question will take a lots of space). So we remove that
         # left whitespace
         examples["question"] = [q.lstrip() for q in examples["question"]]
+        # extra_inputs는 inputs의 prefix이므로 한번만 포맷하고 이어붙입니다.
+        extra_inputs = [
+            "".join((QUESTION_PREFIX, q, CONTEXT_PREFIX)) for q in examples["question"]
+        ]
         inputs = [
-            f"질문: {q}  지문: {c}"
-            for q, c in zip(examples["question"], examples["context"])
+            extra + " " + c for extra, c in zip(extra_inputs, examples["context"])
         ]
-        extra_inputs = [f"질문: {q}  지문:" for q in examples["question"]]
 
         # Tokenize our examples with truncation and padding, but keep the overflows using a stride. This results
         # in one example possible giving several features when a context is long, each of those features having a
@@ -180,9 +231,23 @@ def prepare_train_features_with_setting_for_T5(tokenizer, dataset_args, is_rober
         tokenized_examples["start_positions"] = []
         tokenized_examples["end_positions"] = []
 
-        for i, offsets in enumerate(offset_mapping):
+        # 마지막 content 토큰 위치(padding/eos 제외)를 배치 전체에 대해 한번에 계산합니다.
+        input_ids_arr = np.asarray(tokenized_examples["input_ids"], dtype=np.int32)
+        content_mask = (input_ids_arr != tokenizer.pad_token_id) & (
+            input_ids_arr != tokenizer.eos_token_id
+        )
+        last_content = (
+            content_mask.shape[1] - 1 - np.argmax(content_mask[:, ::-1], axis=1)
+        )
+
+        # tuple list 대신 int32 array로 들고있으면 스캔중 PyObject unboxing이 없습니다.
+        offsets_arr = np.array(offset_mapping, dtype=np.int32)
+        max_len = offsets_arr.shape[1]
+
+        for i in range(len(offset_mapping)):
+            offset_starts = offsets_arr[i, :, 0]
+            offset_ends = offsets_arr[i, :, 1]
             # We will label impossible answers with the index of the CLS token.
-            input_ids = tokenized_examples["input_ids"][i]
             additional_token_length = len(tokenized_extras["input_ids"][i][:-1])
             additional_text_length = len(extra_inputs[i])
             cls_index = tokenizer.eos_token_id  # dataset_args.max_length
@@ -209,17 +274,12 @@ def prepare_train_features_with_setting_for_T5(tokenizer, dataset_args, is_rober
                 token_start_index += additional_token_length
 
                 # End token index of the current span in the text.
-                token_end_index = len(input_ids) - 1
-                while (
-                    input_ids[token_end_index] == tokenizer.pad_token_id
-                    or input_ids[token_end_index] == tokenizer.eos_token_id
-                ):
-                    token_end_index -= 1
+                token_end_index = int(last_content[i])
                 # token_end_index -= additional_length # TODO ?
                 # Detect if the answer is out of the span (in which case this feature is labeled with the CLS index).
                 if not (
-                    offsets[token_start_index][0] <= start_char
-                    and offsets[token_end_index][1] >= end_char
+                    offset_starts[token_start_index] <= start_char
+                    and offset_ends[token_end_index] >= end_char
                 ):
                     tokenized_examples["start_positions"].append(cls_index)
                     tokenized_examples["end_positions"].append(cls_index)
@@ -227,12 +287,12 @@ def prepare_train_features_with_setting_for_T5(tokenizer, dataset_args, is_rober
                     # Otherwise move the token_start_index and token_end_index to the two ends of the answer.
                     # Note: we could go after the last offset if the answer is the last word (edge case).
                     while (  # offset이 정답 시작 인덱스보다 작고, 현재 토큰의 오프셋의 시작이 정답 시작 인덱스보다 작은경우
-                        token_start_index < len(offsets)
-                        and offsets[token_start_index][0] <= start_char
+                        token_start_index < max_len
+                        and offset_starts[token_start_index] <= start_char
                     ):
                         token_start_index += 1
                     tokenized_examples["start_positions"].append(token_start_index - 1)
-                    while offsets[token_end_index][1] >= end_char:
+                    while offset_ends[token_end_index] >= end_char:
                         token_end_index -= 1
                     tokenized_examples["end_positions"].append(token_end_index + 1)
 
@@ -254,11 +314,13 @@ def prepare_validation_features_with_setting_for_T5(
         # Tokenize our examples with truncation and maybe padding, but keep the overflows using a stride. This results
         # in one example possible giving several features when a context is long, each of those features having a
         # context that overlaps a bit the context of the previous feature.
+        # extra_inputs는 inputs의 prefix이므로 한번만 포맷하고 이어붙입니다.
+        extra_inputs = [
+            "".join((QUESTION_PREFIX, q, CONTEXT_PREFIX)) for q in examples["question"]
+        ]
         inputs = [
-            f"질문: {q}  지문: {c}"
-            for q, c in zip(examples["question"], examples["context"])
+            extra + " " + c for extra, c in zip(extra_inputs, examples["context"])
         ]
-        extra_inputs = [f"질문: {q}  지문:" for q in examples["question"]]
 
         # Tokenize our examples with truncation and padding, but keep the overflows using a stride. This results
         # in one example possible giving several features when a context is long, each of those features having a
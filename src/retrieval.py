@@ -42,6 +42,23 @@ def make_retrieval_datasets(retrieval_cfg: RetrievalArguments):
     )
 
 
+def _retrieve_all(retrieval, questions, top_k):
+    # BM25 계열은 질문 전체를 SpMM 한번으로 스코어링합니다.
+    # bulk API가 없는 retrieval(ElasticSearch)은 기존대로 질문별로 조회합니다.
+    if hasattr(retrieval, "get_relevant_doc_bulk"):
+        return retrieval.get_relevant_doc_bulk(questions, k=top_k)
+    results = [retrieval.get_relevant_doc(question, k=top_k) for question in questions]
+    return [scores for scores, _ in results], [context for _, context in results]
+
+
+def _to_context_texts(retrieval, contexts):
+    # BM25 계열 retrieval은 문서 인덱스 array를 반환하므로 본문 텍스트로 변환합니다.
+    # ElasticSearchRetrieval은 본문을 그대로 반환합니다.
+    if hasattr(retrieval, "contexts_arr"):
+        return list(retrieval.contexts_arr[contexts])
+    return contexts
+
+
 def retrieval_question_join_context(
     target_dataset: DatasetDict, retrieval, top_k: int
 ) -> DatasetDict:
@@ -52,10 +69,12 @@ def retrieval_question_join_context(
             datas = {"scores": [], "context": [], "context_list": []}
             for data_key in target_dataset[key].column_names:
                 datas[data_key] = []
+            all_scores, all_contexts = _retrieve_all(
+                retrieval, target_dataset[key]["question"], top_k
+            )
             for idx in tqdm(range(target_dataset[key].num_rows)):
-                scores, context = retrieval.get_relevant_doc(
-                    target_dataset[key]["question"][idx], k=top_k
-                )
+                scores = all_scores[idx]
+                context = _to_context_texts(retrieval, all_contexts[idx])
                 for data_key in target_dataset[key].column_names:
                     datas[data_key].append(target_dataset[key][data_key][idx])
                 datas["scores"].append(sum(scores) / top_k)
@@ -73,10 +92,12 @@ def retrieval_question_one_context(target_dataset, retrieval, top_k) -> DatasetD
             datas = {"scores": [], "context": []}
             for data_key in target_dataset[key].column_names:
                 datas[data_key] = []
+            all_scores, all_contexts = _retrieve_all(
+                retrieval, target_dataset[key]["question"], top_k
+            )
             for idx in tqdm(range(target_dataset[key].num_rows)):
-                scores, context = retrieval.get_relevant_doc(
-                    target_dataset[key]["question"][idx], k=top_k
-                )
+                scores = all_scores[idx]
+                context = _to_context_texts(retrieval, all_contexts[idx])
                 for ctx_idx, ctx in enumerate(context):
                     for data_key in target_dataset[key].column_names:
                         if data_key == "id":
@@ -1,13 +1,15 @@
 import os
 import time
+import json
 
 # import faiss
 import pickle
 import numpy as np
 import pandas as pd
 
-from rank_bm25 import BM25Plus, BM25Okapi, BM25L
+from scipy import sparse
 from tqdm.auto import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from typing import List, Tuple, NoReturn, Optional, Union
 from datasets import Dataset, load_from_disk
@@ -28,17 +30,45 @@ class BM25SparseRetrieval:
         **kwargs,
     ) -> NoReturn:
         self.data_path = data_path
-        wiki_datasets = load_from_disk(os.path.join(data_path, context_path))
 
-        self.contexts = [wiki["text"] for wiki in wiki_datasets]
+        # context 목록을 .npy로 캐싱해두고, 있으면 Arrow 데이터셋 로드 자체를 건너뜁니다.
+        contexts_cache = os.path.join(
+            data_path, f"{context_path}_contexts.npy".replace("/", "-")
+        )
+        if os.path.isfile(contexts_cache):
+            self.contexts_arr = np.load(contexts_cache, allow_pickle=True)
+            self.contexts = self.contexts_arr.tolist()
+        else:
+            wiki_datasets = load_from_disk(os.path.join(data_path, context_path))
+            # row 단위 순회 대신 컬럼을 한번에 읽습니다.
+            self.contexts = wiki_datasets["text"]
+            # 인덱스 array로 한번에 gather할 수 있도록 object array로도 들고있습니다.
+            self.contexts_arr = np.asarray(self.contexts, dtype=object)
+            np.save(contexts_cache, self.contexts_arr)
         print(f"Lengths of unique contexts : {len(self.contexts)}")
         self.ids = list(range(len(self.contexts)))
 
-        self.bm25 = None
+        self.X_bm25 = None
+        self.idf = None
+        self.vocab = None
+        self.bm25_type = None
+        self.delta = None
 
     def tokenizer_fn(self, context) -> List[str]:
         raise "토크나이저를 설정해 주세요"
 
+    def tokenize_corpus(self, contexts: List[str]) -> List[List[str]]:
+
+        """
+        corpus 전체를 한번에 토크나이징합니다.
+        konlpy 계열 토크나이저는 호출중 GIL을 놓으므로 스레드풀로 병렬화해도 순서가 유지됩니다.
+        fast tokenizer를 쓰는 subclass는 배치 호출로 override합니다.
+        """
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            return list(
+                tqdm(executor.map(self.tokenizer_fn, contexts), total=len(contexts))
+            )
+
     def get_sparse_embedding(
         self,
         pickle_name="bm25.bin",
@@ -51,36 +81,161 @@ class BM25SparseRetrieval:
     ) -> NoReturn:
         # 논문기준 가장 큰값을 기본값으로 사용 http://www.cs.otago.ac.nz/homepages/andrew/papers/2014-2.pdf
 
-        pickle_name = f"{k1}_{b}_{ep}_{delta}_{type}_{pickle_name}"
-        pickle_name = pickle_name.replace("/", "-")
-        emd_path = os.path.join(self.data_path, pickle_name)
+        base_name = os.path.splitext(pickle_name)[0].replace("/", "-")
+        index_name = f"{k1}_{b}_{ep}_{delta}_{type}_{base_name}"
+        emd_path = os.path.join(self.data_path, index_name)
 
         print(f"emd_path : {emd_path}")
 
-        if os.path.isfile(emd_path):
-            with open(emd_path, "rb") as file:
-                self.bm25 = pickle.load(file)
-            print("Embedding pickle load.")
+        if os.path.isdir(emd_path):
+            self._load_bm25_matrix(emd_path)
+            print("Embedding index load.")
         else:
             if type not in ["Okapi", "Plus", "L"]:
                 raise "올바른 type을 입력해주세요. Okapi | Plus | L"
             print("Build passage embedding")
-            tokenized_contexts = list(map(self.tokenizer_fn, tqdm(self.contexts)))
-            if type == "Okapi":
-                self.bm25 = BM25Okapi(tokenized_contexts, k1=k1, b=b, epsilon=ep)
-            elif type == "Plus":
-                self.bm25 = BM25Plus(tokenized_contexts, k1=k1, b=b, delta=delta)
+            # 토크나이징 결과는 BM25 하이퍼파라미터와 무관하므로 따로 캐싱합니다.
+            # k1/b 등을 바꿔 index를 다시 만들때 토크나이징은 건너뜁니다.
+            tok_path = os.path.join(self.data_path, f"tokenized_{base_name}.pkl")
+            if os.path.isfile(tok_path):
+                with open(tok_path, "rb") as file:
+                    tokenized_contexts = pickle.load(file)
+                print("Tokenized corpus pickle load.")
             else:
-                self.bm25 = BM25L(tokenized_contexts, k1=k1, b=b, delta=delta)
-            with open(emd_path, "wb") as file:
-                pickle.dump(self.bm25, file)
-            print("Embedding pickle saved.")
+                tokenized_contexts = self.tokenize_corpus(self.contexts)
+                with open(tok_path, "wb") as file:
+                    pickle.dump(tokenized_contexts, file)
+                print("Tokenized corpus pickle saved.")
+            self._build_bm25_matrix(tokenized_contexts, type, k1, b, ep, delta)
+            self._save_bm25_matrix(emd_path)
+            print("Embedding index saved.")
+
+    def _save_bm25_matrix(self, emd_path: str) -> NoReturn:
+        # pickle 대신 CSR 구성 array를 각각 .npy로 저장해 mmap으로 다시 열 수 있게합니다.
+        os.makedirs(emd_path, exist_ok=True)
+        # BM25 점수는 top-k 선택에만 쓰이므로 float16이면 충분합니다. 저장용량 절반.
+        np.save(
+            os.path.join(emd_path, "data.npy"),
+            self.X_bm25.data.astype(np.float16),
+        )
+        np.save(os.path.join(emd_path, "indices.npy"), self.X_bm25.indices)
+        np.save(os.path.join(emd_path, "indptr.npy"), self.X_bm25.indptr)
+        np.save(os.path.join(emd_path, "idf.npy"), self.idf)
+        with open(os.path.join(emd_path, "vocab.json"), "w", encoding="utf-8") as file:
+            json.dump(self.vocab, file, ensure_ascii=False)
+        with open(os.path.join(emd_path, "meta.json"), "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "shape": list(self.X_bm25.shape),
+                    "type": self.bm25_type,
+                    "delta": self.delta,
+                },
+                file,
+            )
+
+    def _load_bm25_matrix(self, emd_path: str) -> NoReturn:
+
+        """
+        .npy로 저장된 index를 mmap으로 엽니다.
+        OS page cache가 파일을 들고있으므로 로드가 즉시 끝나고,
+        hp_optimizing처럼 프로세스를 여러개 띄워도 RAM 한벌을 공유합니다.
+        """
+        # scipy SpMV는 fp16을 지원하지 않으므로 로드하면서 float32로 올립니다.
+        data = np.load(os.path.join(emd_path, "data.npy"), mmap_mode="r").astype(
+            np.float32
+        )
+        indices = np.load(os.path.join(emd_path, "indices.npy"), mmap_mode="r")
+        indptr = np.load(os.path.join(emd_path, "indptr.npy"), mmap_mode="r")
+        self.idf = np.load(os.path.join(emd_path, "idf.npy"))
+        with open(os.path.join(emd_path, "vocab.json"), "r", encoding="utf-8") as file:
+            self.vocab = json.load(file)
+        with open(os.path.join(emd_path, "meta.json"), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        self.X_bm25 = sparse.csr_matrix(
+            (data, indices, indptr), shape=tuple(meta["shape"])
+        )
+        self.bm25_type = meta["type"]
+        self.delta = meta["delta"]
+
+    def _build_bm25_matrix(
+        self, tokenized_contexts, type, k1, b, ep, delta
+    ) -> NoReturn:
+
+        """
+        토크나이징된 corpus로 BM25 가중치가 미리 계산된 CSR matrix를 만듭니다.
+        점수계산이 문서별 파이썬 루프가 아닌 X_bm25 @ q 한번의 SpMV로 끝나도록
+        각 (doc, term)의 BM25 점수를 미리 저장해둡니다. rank_bm25와 동일한 수식을 사용합니다.
+        """
+        vocab = {}
+        indptr = [0]
+        indices = []
+        data = []
+        doc_len = []
+        for tokens in tokenized_contexts:
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, tf in frequencies.items():
+                indices.append(vocab.setdefault(token, len(vocab)))
+                data.append(tf)
+            indptr.append(len(indices))
+            doc_len.append(len(tokens))
+
+        num_docs = len(tokenized_contexts)
+        doc_len = np.array(doc_len, dtype=np.float64)
+        avgdl = doc_len.sum() / num_docs
+        tf = np.array(data, dtype=np.float64)
+        indices = np.array(indices, dtype=np.int64)
+        indptr = np.array(indptr, dtype=np.int64)
+
+        # document frequency => idf (rank_bm25의 _calc_idf와 동일)
+        df = np.bincount(indices, minlength=len(vocab)).astype(np.float64)
+        if type == "Okapi":
+            idf = np.log(num_docs - df + 0.5) - np.log(df + 0.5)
+            idf[idf < 0] = ep * idf.mean()
+        elif type == "Plus":
+            idf = np.log((num_docs + 1) / df)
+        else:
+            idf = np.log(num_docs + 1) - np.log(df + 0.5)
+
+        # 행(문서)별 길이 정규화 항을 nonzero 단위로 펼칩니다.
+        norm = 1 - b + b * doc_len / avgdl
+        norm = np.repeat(norm, np.diff(indptr))
+
+        if type == "Okapi":
+            weight = idf[indices] * tf * (k1 + 1) / (tf + k1 * norm)
+        elif type == "Plus":
+            # Plus의 delta * idf 항은 모든 문서에 동일하게 더해지므로
+            # matrix에는 tf 의존 항만 저장하고 쿼리시 상수로 더해줍니다.
+            weight = idf[indices] * tf * (k1 + 1) / (k1 * norm + tf)
+        else:
+            ctd = tf / norm
+            weight = idf[indices] * tf * (k1 + 1) * (ctd + delta) / (k1 + ctd + delta)
+
+        self.X_bm25 = sparse.csr_matrix(
+            (weight, indices, indptr), shape=(num_docs, len(vocab))
+        )
+        self.idf = idf
+        self.vocab = vocab
+        self.bm25_type = type
+        self.delta = delta
+
+    def _make_query_vector(self, tokenized_query: List[str]) -> sparse.csr_matrix:
+        cols = [self.vocab[token] for token in tokenized_query if token in self.vocab]
+        rows = np.zeros(len(cols), dtype=np.int64)
+        data = np.ones(len(cols), dtype=np.float64)
+        return sparse.csr_matrix(
+            (data, (rows, cols)), shape=(1, len(self.vocab))
+        )
 
     def retrieve(
-        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
-    ) -> Union[Tuple[List, List], pd.DataFrame]:
+        self,
+        query_or_dataset: Union[str, Dataset],
+        topk: Optional[int] = 1,
+        return_df: Optional[bool] = False,
+    ) -> Union[Tuple[List, List], Dataset, pd.DataFrame]:
 
-        assert self.bm25 is not None, "get_sparse_embedding() 메소드를 먼저 수행해줘야합니다."
+        assert self.X_bm25 is not None, "get_sparse_embedding() 메소드를 먼저 수행해줘야합니다."
 
         if isinstance(query_or_dataset, str):
             doc_scores, doc_indices = self.get_relevant_doc(query_or_dataset, k=topk)
@@ -94,32 +249,33 @@ class BM25SparseRetrieval:
 
         elif isinstance(query_or_dataset, Dataset):
 
-            # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
-            total = []
-            doc_scores, doc_indices = [], []
+            # Retrieve한 Passage를 Arrow 기반 Dataset으로 반환합니다.
+            # (pandas가 필요하면 return_df=True로 기존 DataFrame을 받을 수 있습니다.)
             with timer("query exhaustive search"):
-                for question in tqdm(query_or_dataset["question"]):
-                    doc_score, doc_indice = self.get_relevant_doc(question, k=topk)
-                    doc_scores.append(doc_score)
-                    doc_indices.append(doc_indice)
-            for idx, example in enumerate(
-                tqdm(query_or_dataset, desc="Sparse retrieval: ")
-            ):
-                tmp = {
-                    # Query와 해당 id를 반환합니다.
-                    "question": example["question"],
-                    "id": example["id"],
-                    # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[idx],
-                    "context": " ".join(doc_indices[idx]),
-                }
-                if "context" in example.keys() and "answers" in example.keys():
-                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
-                    tmp["original_context"] = example["context"]
-                    tmp["answers"] = example["answers"]
-                total.append(tmp)
-
-            cqas = pd.DataFrame(total)
+                doc_scores, doc_indices = self.get_relevant_doc_bulk(
+                    query_or_dataset["question"], k=topk
+                )
+            # 행 단위 dict 대신 컬럼 단위로 한번에 모아 DataFrame을 만듭니다.
+            columns = {
+                # Query와 해당 id를 반환합니다.
+                "question": query_or_dataset["question"],
+                "id": query_or_dataset["id"],
+                # Retrieve한 Passage의 id, context를 반환합니다.
+                "context_id": doc_indices.tolist(),
+                "context": [
+                    " ".join(row) for row in self.contexts_arr[doc_indices]
+                ],
+            }
+            column_names = query_or_dataset.column_names
+            if "context" in column_names and "answers" in column_names:
+                # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
+                columns["original_context"] = query_or_dataset["context"]
+                columns["answers"] = query_or_dataset["answers"]
+
+            if return_df:
+                return pd.DataFrame(columns)
+
+            cqas = Dataset.from_dict(columns)
             return cqas
 
     def get_relevant_doc(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
@@ -131,14 +287,57 @@ class BM25SparseRetrieval:
             k (Optional[int]): 1
                 상위 몇 개의 Passage를 반환할지 정합니다.
         Note:
-            vocab 에 없는 이상한 단어로 query 하는 경우 assertion 발생 (예) 뙣뙇?
+            점수계산은 미리 만들어둔 BM25 CSR matrix와 쿼리벡터의 SpMV 한번으로 끝납니다.
+            문서 인덱스를 int array로 반환하며, 본문은 contexts_arr[doc_indices]로 얻습니다.
         """
         tokenized_query = self.tokenizer_fn(query)
-        raw_doc_scores = self.bm25.get_scores(tokenized_query)
+        query_vec = self._make_query_vector(tokenized_query)
+        raw_doc_scores = (self.X_bm25 @ query_vec.T).toarray().ravel()
+        if self.bm25_type == "Plus":
+            # 문서 전체에 동일한 delta * idf 상수항을 더해 rank_bm25와 같은 점수로 맞춥니다.
+            raw_doc_scores += self.delta * (query_vec @ self.idf)[0]
+
+        # 전체 정렬 대신 top-k만 partition한 뒤 그 k개만 정렬합니다. O(N + k log k)
+        partition = np.argpartition(-raw_doc_scores, k)[:k]
+        doc_indices = partition[np.argsort(-raw_doc_scores[partition])]
+
+        return raw_doc_scores[doc_indices], doc_indices
+
+    def get_relevant_doc_bulk(
+        self, queries: List[str], k: Optional[int] = 1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Arguments:
+            queries (List[str]):
+                여러개의 Query를 한번에 받습니다.
+            k (Optional[int]): 1
+                상위 몇 개의 Passage를 반환할지 정합니다.
+        Note:
+            쿼리 전체를 (N_queries x |V|) CSR matrix로 만들어 SpMM 한번으로 점수를 계산합니다.
+            반환값은 (N_queries x k) 크기의 점수/문서 인덱스 array입니다.
+        """
+        tokenized_queries = self.tokenize_corpus(queries)
+        rows, cols = [], []
+        for row, tokens in enumerate(tokenized_queries):
+            for token in tokens:
+                col = self.vocab.get(token)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        query_mat = sparse.csr_matrix(
+            (np.ones(len(cols), dtype=np.float64), (rows, cols)),
+            shape=(len(queries), len(self.vocab)),
+        )
 
-        doc_scores_index_desc = np.argsort(-raw_doc_scores)
-        doc_scores = raw_doc_scores[doc_scores_index_desc]
+        scores = (self.X_bm25 @ query_mat.T).toarray()  # (N_docs, N_queries)
+        if self.bm25_type == "Plus":
+            scores += self.delta * (query_mat @ self.idf)[np.newaxis, :]
 
-        doc_list = self.bm25.get_top_n(tokenized_query, self.contexts, k)
+        part = np.argpartition(-scores, k, axis=0)[:k]
+        part_scores = np.take_along_axis(scores, part, axis=0)
+        order = np.argsort(-part_scores, axis=0)
+        doc_indices = np.take_along_axis(part, order, axis=0).T
+        doc_scores = np.take_along_axis(part_scores, order, axis=0).T
 
-        return doc_scores[:k], doc_list
+        return doc_scores, doc_indices
@@ -19,6 +19,13 @@ class TokenizerRetrieval(BM25SparseRetrieval):
     def tokenizer_fn(self, context) -> List[str]:
         return self.tokenizer.tokenize(context)
 
+    def tokenize_corpus(self, contexts: List[str]) -> List[List[str]]:
+        # fast tokenizer는 배치 호출 한번이면 Rust쪽에서 스레드 병렬화됩니다.
+        encodings = self.tokenizer.backend_tokenizer.encode_batch(
+            contexts, add_special_tokens=False
+        )
+        return [encoding.tokens for encoding in encodings]
+
     def get_sparse_embedding(
         self,
         pickle_name="bm25.bin",
@@ -68,6 +68,8 @@ def train(project_args, model_args, dataset_args, train_args, early_stopping_arg
         if model_args.is_T5
         else prepare_train_features_with_setting(tokenizer, dataset_args, is_roberta),
         batched=True,
+        batch_size=1000,
+        num_proc=dataset_args.preprocessing_num_workers,
         remove_columns=datasets["train"].column_names,
     )
 
@@ -80,6 +82,8 @@ def train(project_args, model_args, dataset_args, train_args, early_stopping_arg
             tokenizer, dataset_args, is_roberta
         ),
         batched=True,
+        batch_size=1000,
+        num_proc=dataset_args.preprocessing_num_workers,
         remove_columns=datasets["validation"].column_names,
     )
 